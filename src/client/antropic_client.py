@@ -1,16 +1,20 @@
 # MCP Client for Composite Agent
 import asyncio
 from dataclasses import dataclass, field
-from typing import Union, cast, Dict, Any, List
-from jsonschema import validate, ValidationError
+from typing import Callable, Union, cast, Dict, Any, List
+import fastjsonschema
 from tenacity import retry, wait_exponential, stop_after_attempt
 import anthropic
 from anthropic.types import MessageParam, TextBlock, ToolUnionParam, ToolUseBlock
 from dotenv import load_dotenv
+import tiktoken
 from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from session_cache import get_session, release_session, close_session, list_tools
+from tool_cache import ToolCache
 from loguru import logger
 import os
+import sys
+import orjson
 import datetime
 
 # Configure loguru for detailed tracing to file
@@ -24,8 +28,9 @@ logger.remove()  # Remove default handler
 logger.add(log_file, 
            level="TRACE", 
            format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-           rotation="20 MB")
-logger.add(lambda msg: print(msg, flush=True), level="INFO", format="{message}")
+           rotation="20 MB",
+           enqueue=True)  # Write from a background thread so logging never blocks the event loop
+logger.add(sys.stdout, level="INFO", format="{message}", enqueue=True)
 
 logger.info(f"Starting new chat session. Log file: {log_file}")
 
@@ -33,8 +38,52 @@ logger.info(f"Starting new chat session. Log file: {log_file}")
 load_dotenv()
 
 anthropic_client = anthropic.AsyncAnthropic()
+MODEL = "claude-3-7-sonnet-20250219"
 MAX_TOKENS = 100000  # Conservative limit for Claude's 200k context window
 RETRY_ATTEMPTS = 3
+BATCH_TOOL = "batch_execute"  # Composite server tool that fans out several calls
+TOKEN_SYNC_INTERVAL = 10  # Turns between server-side count_tokens drift checks
+TOKENS_PER_BLOCK = 8  # Framing overhead of a tool_use/tool_result block
+COMPACT_KEEP_MESSAGES = 8  # Most recent messages (~4 tool round-trips) never compacted
+COMPACT_RESULT_CHARS = 2048  # Older tool results longer than this are elided
+TRUNCATED_MARKER = "...[truncated]"
+
+# Local tokenizer approximating Claude's; keeps truncation off the network
+encoder = tiktoken.get_encoding("cl100k_base")
+
+def _block_field(block: Any, name: str) -> Any:
+    """Read a field from a content block given as a dict or an SDK model"""
+    return block.get(name) if isinstance(block, dict) else getattr(block, name, None)
+
+
+def _count_tokens(message: MessageParam) -> int:
+    """Estimate the token count of a single message locally"""
+    content = message["content"]
+    if isinstance(content, str):
+        return len(encoder.encode_ordinary(content))
+
+    tokens = 0
+    for block in content:
+        block_type = _block_field(block, "type")
+        if block_type == "text":
+            tokens += len(encoder.encode_ordinary(_block_field(block, "text")))
+        elif block_type == "tool_use":
+            tool_input = orjson.dumps(_block_field(block, "input")).decode()
+            tokens += len(encoder.encode_ordinary(_block_field(block, "name") + tool_input)) + TOKENS_PER_BLOCK
+        elif block_type == "tool_result":
+            tokens += len(encoder.encode_ordinary(str(_block_field(block, "content") or ""))) + TOKENS_PER_BLOCK
+        else:
+            tokens += TOKENS_PER_BLOCK
+    return tokens
+
+def _compile_validator(name: str, schema: dict) -> Callable[[Any], Any] | None:
+    """Compile a tool's input schema once; None if the schema is unsupported"""
+    try:
+        # Validate only; filling schema defaults would put explicit nulls into the call arguments
+        return fastjsonschema.compile(schema, use_default=False)
+    except fastjsonschema.JsonSchemaDefinitionException as e:
+        logger.warning(f"Skipping input validation for {name}: {str(e)}")
+        return None
 
 # Create server parameters for stdio connection
 server_params = StdioServerParameters(
@@ -54,70 +103,220 @@ class Chat:
     3. If the lambda function cannot process the message, it returns an error message.
     """
     available_tools: list[ToolUnionParam] = field(default_factory=list)
+    _validators: dict[str, Callable[[Any], Any] | None] = field(default_factory=dict, init=False, repr=False)
+    _tools_by_name: dict[str, ToolUnionParam] = field(default_factory=dict, init=False, repr=False)
+    _msg_tokens: list[int] = field(default_factory=list, init=False, repr=False)
+    _total_tokens: int = field(default=0, init=False, repr=False)
+    _turns_since_sync: int = field(default=0, init=False, repr=False)
+    _cache_block: dict | None = field(default=None, init=False, repr=False)
+    _request_params: dict[str, Any] = field(default_factory=dict, init=False, repr=False)
+    _tool_cache: ToolCache = field(default_factory=ToolCache, init=False, repr=False)
+
+    def __post_init__(self):
+        # Seed the token cache for any history passed in
+        self._msg_tokens = [_count_tokens(m) for m in self.messages]
+        self._total_tokens = sum(self._msg_tokens)
+
+    def _append_message(self, message: MessageParam) -> None:
+        """Append a message to history and account for its tokens"""
+        tokens = _count_tokens(message)
+        self.messages.append(message)
+        self._msg_tokens.append(tokens)
+        self._total_tokens += tokens
 
     async def initialize_tools(self, session: ClientSession) -> None:
         """Fetch and cache available tools with schemas"""
         print("📋 Initializing available tools...")
-        response = await session.list_tools()
+        response = await list_tools(session)
+        # batch_execute is client plumbing, not a tool for the model
+        tools = [tool for tool in response.tools if tool.name != BATCH_TOOL]
+        # Interned names let per-call lookups short-circuit on identity
         self.available_tools = [
             {
-                "name": tool.name,
+                "name": sys.intern(tool.name),
                 "description": tool.description or "",
                 "input_schema": tool.inputSchema,
             }
-            for tool in response.tools
+            for tool in tools
         ]
+        self._tools_by_name = {t["name"]: t for t in self.available_tools}
+        self._validators = {
+            sys.intern(tool.name): _compile_validator(tool.name, tool.inputSchema)
+            for tool in tools
+        }
+        # Only tools the server marks read-only are safe to answer from cache
+        self._tool_cache.cacheable = {
+            sys.intern(tool.name) for tool in tools
+            if getattr(getattr(tool, "annotations", None), "readOnlyHint", False)
+        }
+        if self.available_tools:
+            # Cache breakpoint after the tool list, which is stable for the session
+            self.available_tools[-1]["cache_control"] = {"type": "ephemeral"}
+        # Request fields that never change during the session, built once
+        self._request_params = {
+            "model": MODEL,
+            "system": [{
+                "type": "text",
+                "text": self.system_prompt,
+                "cache_control": {"type": "ephemeral"},
+            }],
+            "max_tokens": 8000,
+            "tools": self.available_tools,
+        }
         logger.info(f"Available tools initialized: {[t['name'] for t in self.available_tools]}")
         print(f"✅ Initialized {len(self.available_tools)} tools")
 
+    def _recount_message(self, index: int) -> None:
+        """Refresh the cached token count of a message edited in place"""
+        tokens = _count_tokens(self.messages[index])
+        self._total_tokens += tokens - self._msg_tokens[index]
+        self._msg_tokens[index] = tokens
+
+    def _compact_history(self) -> None:
+        """Elide large tool results and images outside the recent history window"""
+        cutoff = len(self.messages) - COMPACT_KEEP_MESSAGES
+        if cutoff <= 0:
+            return
+
+        tool_names = {}
+        latest_results = {}  # Tool name -> tool_use_id of its most recent result
+        for message in self.messages:
+            if isinstance(message["content"], str):
+                continue
+            for block in message["content"]:
+                block_type = _block_field(block, "type")
+                if block_type == "tool_use":
+                    tool_names[_block_field(block, "id")] = _block_field(block, "name")
+                elif block_type == "tool_result":
+                    latest_results[tool_names.get(block["tool_use_id"])] = block["tool_use_id"]
+        keep = set(latest_results.values())
+
+        for index in range(cutoff):
+            message = self.messages[index]
+            if message["role"] != "user" or isinstance(message["content"], str):
+                continue
+            changed = False
+            for i, block in enumerate(message["content"]):
+                if not isinstance(block, dict):
+                    continue
+                if block["type"] == "tool_result" and block["tool_use_id"] not in keep:
+                    content = block["content"]
+                    if isinstance(content, str) and len(content) > COMPACT_RESULT_CHARS:
+                        block["content"] = f"[elided {len(content)} chars; tool={tool_names.get(block['tool_use_id'])}]"
+                        changed = True
+                elif block["type"] == "image":
+                    message["content"][i] = {"type": "text", "text": "[elided image]"}
+                    changed = True
+            if changed:
+                self._recount_message(index)
+
+    def _shrink_message(self, index: int) -> bool:
+        """Truncate a message's tool results in place; returns whether anything changed"""
+        message = self.messages[index]
+        if isinstance(message["content"], str):
+            return False
+        changed = False
+        for block in message["content"]:
+            if isinstance(block, dict) and block["type"] == "tool_result":
+                content = block["content"]
+                # Results already cut down are COMPACT_RESULT_CHARS plus the marker; leave them be
+                if isinstance(content, str) and len(content) > COMPACT_RESULT_CHARS + len(TRUNCATED_MARKER):
+                    block["content"] = content[:COMPACT_RESULT_CHARS] + TRUNCATED_MARKER
+                    changed = True
+        if changed:
+            self._recount_message(index)
+        return changed
+
+    def _mark_cache_breakpoint(self) -> None:
+        """Move the conversation cache breakpoint onto the last message's final block"""
+        message = self.messages[-1]
+        if isinstance(message["content"], str):
+            message["content"] = [{"type": "text", "text": message["content"]}]
+        block = message["content"][-1]
+        if not isinstance(block, dict):
+            return
+
+        # Only one moving breakpoint; the API caps the number per request
+        if self._cache_block is not None:
+            self._cache_block.pop("cache_control", None)
+        block["cache_control"] = {"type": "ephemeral"}
+        self._cache_block = block
+
     @retry(wait=wait_exponential(multiplier=1, min=1, max=10), 
            stop=stop_after_attempt(RETRY_ATTEMPTS))
-    async def claude_request(self, **kwargs) -> anthropic.types.Message:
-        """Wrapper with retry logic for Claude API calls"""
-        print(f"🤖 Sending request to Claude API...")
+    async def claude_request(self, session: ClientSession, **kwargs) -> tuple[anthropic.types.Message, list[asyncio.Task]]:
+        """Stream a Claude response with retry, starting read-only tool calls as soon as they are complete"""
+        logger.trace("🤖 Sending request to Claude API...")
+        tasks = []
+        started = set()
         try:
-            response = await anthropic_client.messages.create(**kwargs)
-            print(f"✅ Received response from Claude API")
-            return response
-        except anthropic.APIError as e:
-            print(f"❌ Claude API error: {str(e)}")
+            async with anthropic_client.messages.stream(**kwargs) as stream:
+                async for event in stream:
+                    # Overlap read-only tools with the rest of the generation. Anything with side
+                    # effects waits for the full response: a retry would otherwise run it twice
+                    block = event.content_block if event.type == "content_block_stop" else None
+                    if block is not None and block.type == "tool_use" and block.name in self._tool_cache.cacheable:
+                        tasks.append(asyncio.create_task(self.process_tool_use(session, block)))
+                        started.add(block.id)
+                response = await stream.get_final_message()
+            tasks.extend(
+                asyncio.create_task(self.process_tool_use(session, block))
+                for block in response.content
+                if isinstance(block, ToolUseBlock) and block.id not in started
+            )
+            logger.trace("✅ Received response from Claude API")
+            logger.debug(
+                f"Prompt cache: read {response.usage.cache_read_input_tokens} tokens, "
+                f"wrote {response.usage.cache_creation_input_tokens} tokens"
+            )
+            return response, tasks
+        except Exception as e:
+            # A retry re-generates the tool calls, so drop the read-only ones from this attempt
+            for task in tasks:
+                task.cancel()
             logger.error(f"Claude API error: {str(e)}")
             raise
 
     async def _truncate_messages(self):
         """Maintain conversation history within token limits"""
-        print("📏 Checking conversation token count...")
-        token_count = await anthropic_client.messages.count_tokens(
-            model="claude-3-7-sonnet-20250219",
-            messages=self.messages
-        )
-        print(f"📊 Current token count: {token_count.input_tokens}/{MAX_TOKENS}")
-        
-        while token_count.input_tokens > MAX_TOKENS:
+        self._turns_since_sync += 1
+        if self._turns_since_sync >= TOKEN_SYNC_INTERVAL:
+            # Periodically correct drift between the local estimate and Claude's tokenizer
+            self._turns_since_sync = 0
+            token_count = await anthropic_client.messages.count_tokens(
+                model=MODEL,
+                messages=self.messages
+            )
+            logger.debug(f"Token drift check: local {self._total_tokens}, server {token_count.input_tokens}")
+            self._total_tokens = token_count.input_tokens
+        logger.trace("📊 Current token count: {}/{}", self._total_tokens, MAX_TOKENS)
+
+        while self._total_tokens > MAX_TOKENS:
             if len(self.messages) > 1:
+                if self._msg_tokens[1] > MAX_TOKENS // 2:
+                    # Cut a single oversized tool result down rather than scanning history around it;
+                    # pop it as usual once shrinking stops making it smaller
+                    before = self._msg_tokens[1]
+                    if self._shrink_message(1) and self._msg_tokens[1] < before:
+                        continue
                 removed = self.messages.pop(1)  # Preserve system prompt
-                print(f"✂️ Truncated message: {str(removed)[:50]}...")
-                logger.warning(f"Truncated message: {str(removed)[:50]}...")
-                # Recalculate tokens after removing a message
-                token_count = await anthropic_client.messages.count_tokens(
-                    model="claude-3-7-sonnet-20250219",
-                    messages=self.messages
-                )
-                print(f"📊 Updated token count: {token_count.input_tokens}/{MAX_TOKENS}")
+                self._total_tokens -= self._msg_tokens.pop(1)
+                logger.opt(lazy=True).warning("✂️ Truncated message: {}...", lambda: str(removed)[:50])
+                logger.trace("📊 Updated token count: {}/{}", self._total_tokens, MAX_TOKENS)
             else:
-                print("⚠️ Cannot truncate further - only system message remains")
+                logger.warning("⚠️ Cannot truncate further - only system message remains")
                 break
 
 
-    async def process_tool_use(self, session: ClientSession, tool_use: ToolUseBlock) -> dict:
-        """Execute tool with validation and error handling"""
-        print(f"🛠️ Executing tool: {tool_use.name} (ID: {tool_use.id})")
-        print(f"📥 Tool input: {tool_use.input}")
+    def _check_tool_use(self, tool_use: ToolUseBlock) -> dict | None:
+        """Validate a tool call; returns an error result, or None if it can run"""
+        logger.trace("🛠️ Executing tool: {} (ID: {})", tool_use.name, tool_use.id)
+        logger.trace("📥 Tool input: {}", tool_use.input)
         
-        tool = next((t for t in self.available_tools if t["name"] == tool_use.name), None)
+        tool = self._tools_by_name.get(tool_use.name)
         
         if not tool:
-            print(f"❌ Tool '{tool_use.name}' not found")
+            logger.error("❌ Tool '{}' not found", tool_use.name)
             return {
                 "tool_use_id": tool_use.id,
                 "content": f"Tool '{tool_use.name}' not found"
@@ -125,68 +324,76 @@ class Chat:
         
         try:
             # Validate against tool schema
-            print(f"🔍 Validating input against schema for {tool_use.name}...")
-            validate(instance=tool_use.input, schema=tool["input_schema"])
-            print(f"✅ Input validation successful")
-            
+            validator = self._validators.get(tool_use.name)
+            if validator is not None:
+                validator(tool_use.input)
+            return None
+        except fastjsonschema.JsonSchemaValueException as ve:
+            error_msg = f"Validation error: {str(ve)}"
+            logger.error(f"Validation error for {tool_use.name}: {str(ve)}")
+            return {"tool_use_id": tool_use.id, "content": error_msg}
+
+    async def process_tool_use(self, session: ClientSession, tool_use: ToolUseBlock) -> dict:
+        """Execute tool with validation and error handling"""
+        error = self._check_tool_use(tool_use)
+        if error is not None:
+            return error
+        
+        cache_key = self._tool_cache.key(tool_use.name, tool_use.input)
+        if cache_key is not None and (cached := self._tool_cache.get(cache_key)) is not None:
+            logger.trace("♻️ Cached result for {}", tool_use.name)
+            return {"tool_use_id": tool_use.id, "content": cached}
+
+        try:
             # Execute tool
-            print(f"⚙️ Executing {tool_use.name}...")
             result = await session.call_tool(tool_use.name, cast(dict, tool_use.input))
             tool_result = {
                 "tool_use_id": tool_use.id,
                 "content": result.content[0].text if result.content else ""
             }
-            print(f"✅ Tool execution complete")
-            print(f"📤 Tool result: {tool_result['content'][:100]}..." if len(tool_result['content']) > 100 else f"📤 Tool result: {tool_result['content']}")
+            if cache_key is not None and not result.isError:
+                self._tool_cache.put(cache_key, tool_result["content"])
+            logger.opt(lazy=True).trace("📤 Tool result: {}", lambda: tool_result["content"][:100])
             return tool_result
             
-        except ValidationError as ve:
-            error_msg = f"Validation error: {str(ve)}"
-            print(f"❌ {error_msg}")
-            logger.error(f"Validation error for {tool_use.name}: {str(ve)}")
-            return {"tool_use_id": tool_use.id, "content": error_msg}
         except Exception as e:
             error_msg = f"Execution error: {str(e)}"
-            print(f"❌ {error_msg}")
             logger.error(f"Tool execution error for {tool_use.name}: {str(e)}")
             return {"tool_use_id": tool_use.id, "content": error_msg}
 
     async def process_query(self, session: ClientSession, query: str) -> None:
         """Enhanced query processing with full tool handling"""
-        print("\n" + "="*50)
-        print(f"📝 Processing query: {query}")
-        self.messages.append({"role": "user", "content": query})
+        logger.trace("📝 Processing query: {}", query)
+        self._append_message({"role": "user", "content": query})
         
         iteration = 0
         while True:
             if iteration > 0:
-                print(f"\n🔄 Iteration {iteration+1} - Processing tool results...")
+                logger.trace("🔄 Iteration {} - Processing tool results...", iteration + 1)
             iteration += 1
             
             try:
-                # Get Claude response with retry
-                print(f"🧠 Thinking...")
-                res = await self.claude_request(
-                    model="claude-3-7-sonnet-20250219",
-                    system=self.system_prompt,
-                    max_tokens=8000,
+                # Stream Claude response with retry
+                self._mark_cache_breakpoint()
+                res, tool_tasks = await self.claude_request(
+                    session,
                     messages=self.messages,
-                    tools=self.available_tools,
+                    **self._request_params,
                 )
             except Exception as e:
                 error_msg = f"System error: Failed to get response ({str(e)})"
-                self.messages.append({
+                self._append_message({
                     "role": "assistant", 
                     "content": error_msg
                 })
-                print(f"❌ {error_msg}")
+                logger.error(error_msg)
                 break
 
             # Process response content
             tool_uses = [c for c in res.content if isinstance(c, ToolUseBlock)]
             text_blocks = [c for c in res.content if isinstance(c, TextBlock)]
 
-            print(f"📊 Response breakdown: {len(text_blocks)} text blocks, {len(tool_uses)} tool calls")
+            logger.trace("📊 Response breakdown: {} text blocks, {} tool calls", len(text_blocks), len(tool_uses))
 
             # Print immediate text response
             if text_blocks:
@@ -195,24 +402,27 @@ class Chat:
                     print(block.text)
 
             if not tool_uses:
-                print("✅ Query complete - no tools needed")
+                logger.trace("✅ Query complete - no tools needed")
                 # Add full response to messages for history
-                self.messages.append({
+                self._append_message({
                     "role": "assistant",
                     "content": res.content
                 })
                 break  # Exit loop if no tools needed
             else:
-                print(f"\n🛠️ Tools requested: {', '.join([t.name for t in tool_uses])}")
+                logger.info("🛠️ Tools requested: {}", ", ".join(t.name for t in tool_uses))
 
-            # Process all tool uses in parallel
-            print("⚙️ Executing tools in parallel...")
-            tool_results = await asyncio.gather(
-                *[self.process_tool_use(session, tool_use) for tool_use in tool_uses]
-            )
+            # Tools were started while streaming; report each as it finishes
+            tool_names = {t.id: t.name for t in tool_uses}
+            results_by_id = {}
+            for next_result in asyncio.as_completed(tool_tasks):
+                result = await next_result
+                logger.info("✔ {} done", tool_names.get(result["tool_use_id"], result["tool_use_id"]))
+                results_by_id[result["tool_use_id"]] = result
+            tool_results = [results_by_id[t.id] for t in tool_uses if t.id in results_by_id]
 
             # Update conversation history
-            self.messages.append({
+            self._append_message({
                 "role": "assistant",
                 "content": res.content
             })
@@ -224,17 +434,15 @@ class Chat:
                 "content": result["content"]
             } for result in tool_results]
             
-            print("\n📤 Sending tool results back to Claude...")
-            self.messages.append({
+            self._append_message({
                 "role": "user",
                 "content": tool_results_content
             })
 
             # Maintain token window
+            self._compact_history()
             await self._truncate_messages()
 
-        print("="*50 + "\n")
-
     async def chat_loop(self, session: ClientSession):
         """Main chat interface with session management"""
         print("\n🚀 Starting chat interface")
@@ -259,14 +467,19 @@ class Chat:
                 print(f"❌ Chat error: {str(e)}")
                 print("Sorry, an error occurred. Please try again.")
 
+    async def attach(self, session: ClientSession) -> None:
+        """Prepare this chat to run queries over a session the caller already holds"""
+        await self.initialize_tools(session)
+
     async def run(self):
         """Main entry point with connection management"""
         print("🔌 Establishing connection to server...")
-        async with stdio_client(server_params) as (read, write):
-            print("✅ Connection established")
-            async with ClientSession(read, write) as session:
-                print("🔄 Initializing session...")
-                await session.initialize()
-                print("✅ Session initialized")
-                await self.chat_loop(session)
-                print("👋 Session ended")
+        session = await get_session(server_params)
+        print("✅ Session initialized")
+        try:
+            await self.chat_loop(session)
+        finally:
+            if release_session() == 0:
+                # No one else holds the session, so stop the server before the loop shuts down
+                await close_session()
+        print("👋 Session ended")
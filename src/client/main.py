@@ -9,6 +9,11 @@
 import asyncio
 import argparse
 
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the chat agent")
     parser.add_argument("--provider", choices=["anthropic", "openai"], required=True, help="Select the chat provider")
@@ -21,4 +26,7 @@ if __name__ == "__main__":
 
     print(f"🚀 Starting chat agent with {args.provider.capitalize()}")
     chat = Chat()
-    asyncio.run(chat.run())
+    if uvloop is not None:
+        uvloop.run(chat.run())
+    else:
+        asyncio.run(chat.run())
@@ -1,19 +1,22 @@
 # support_agent.py
 from dataclasses import dataclass, field
-from typing import Union, cast, Dict, Any, List
+from typing import Callable, Union, cast, Dict, Any, List
 import asyncio
-import json
 import os
+import sys
 import datetime
 
 import openai
-from jsonschema import validate, ValidationError
+import orjson
+import tiktoken
+import fastjsonschema
 from tenacity import retry, wait_exponential, stop_after_attempt
 from dotenv import load_dotenv
 from loguru import logger
 
 from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from session_cache import get_session, release_session, close_session, list_tools
+from tool_cache import ToolCache
 
 # Configure logging
 log_directory = "logs"
@@ -25,8 +28,9 @@ logger.remove()
 logger.add(log_file, 
            level="TRACE", 
            format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-           rotation="20 MB")
-logger.add(lambda msg: print(msg, flush=True), level="INFO", format="{message}")
+           rotation="20 MB",
+           enqueue=True)  # Write from a background thread so logging never blocks the event loop
+logger.add(sys.stdout, level="INFO", format="{message}", enqueue=True)
 
 load_dotenv()
 
@@ -34,6 +38,41 @@ load_dotenv()
 MAX_TOKENS = 100000
 RETRY_ATTEMPTS = 3
 MODEL = "gpt-4o"
+TOKENS_PER_MESSAGE = 4  # Chat format framing overhead per message
+COMPACT_KEEP_MESSAGES = 8  # Most recent messages (~4 tool round-trips) never compacted
+COMPACT_RESULT_CHARS = 2048  # Older tool results longer than this are elided
+TRUNCATED_MARKER = "...[truncated]"
+OFFLOAD_ARGS_BYTES = 4096  # Tool arguments larger than this are parsed off the event loop
+BATCH_TOOL = "batch_execute"  # Composite server tool that fans out several calls
+
+def _compile_validator(name: str, schema: dict) -> Callable[[Any], Any] | None:
+    """Compile a tool's input schema once; None if the schema is unsupported"""
+    try:
+        # Validate only; filling schema defaults would put explicit nulls into the call arguments
+        return fastjsonschema.compile(schema, use_default=False)
+    except fastjsonschema.JsonSchemaDefinitionException as e:
+        logger.warning(f"Skipping input validation for {name}: {str(e)}")
+        return None
+
+# Tokenizer for MODEL; per-message counts are cached so truncation never re-encodes
+encoder = tiktoken.encoding_for_model(MODEL)
+
+
+def _count_tokens(message: Dict[str, Any]) -> int:
+    """Count the tokens of a single chat message locally"""
+    tokens = TOKENS_PER_MESSAGE
+    if message.get("content"):
+        tokens += len(encoder.encode_ordinary(message["content"]))
+    for tool_call in message.get("tool_calls") or []:
+        tokens += len(encoder.encode_ordinary(tool_call.function.name + tool_call.function.arguments))
+    return tokens
+
+def _parse_tool_args(arguments: str, validator: Callable[[Any], Any] | None) -> dict:
+    """Parse tool call arguments and validate them against the tool schema"""
+    tool_args = orjson.loads(arguments)
+    if validator is not None:
+        validator(tool_args)
+    return tool_args
 
 # Server parameters
 server_params = StdioServerParameters(
@@ -58,27 +97,101 @@ class Chat:
     The default aws region is us-east-1
     """
     available_tools: list[Dict[str, Any]] = field(default_factory=list)
+    _validators: dict[str, Callable[[Any], Any] | None] = field(default_factory=dict, init=False, repr=False)
+    _tools_by_name: dict[str, Dict[str, Any]] = field(default_factory=dict, init=False, repr=False)
+    _batch_supported: bool = field(default=False, init=False, repr=False)
+    _tool_cache: ToolCache = field(default_factory=ToolCache, init=False, repr=False)
+    _msg_tokens: list[int] = field(default_factory=list, init=False, repr=False)
+    _total_tokens: int = field(default=0, init=False, repr=False)
     
     def __post_init__(self):
         # Initialize OpenAI client
         self.client = openai.AsyncOpenAI()
+        # Keep the system prompt as the first message; truncation never pops it
+        if not self.messages or self.messages[0]["role"] != "system":
+            self.messages.insert(0, {"role": "system", "content": self.system_prompt})
+        # Seed the token cache for any history passed in
+        self._msg_tokens = [_count_tokens(m) for m in self.messages]
+        self._total_tokens = sum(self._msg_tokens)
         logger.info("Chat instance initialized")
+
+    def _append_message(self, message: Dict[str, Any]) -> None:
+        """Append a message to history and account for its tokens"""
+        tokens = _count_tokens(message)
+        self.messages.append(message)
+        self._msg_tokens.append(tokens)
+        self._total_tokens += tokens
     
+    def _recount_message(self, index: int) -> None:
+        """Refresh the cached token count of a message edited in place"""
+        tokens = _count_tokens(self.messages[index])
+        self._total_tokens += tokens - self._msg_tokens[index]
+        self._msg_tokens[index] = tokens
+
+    def _compact_history(self) -> None:
+        """Elide large tool results outside the recent history window"""
+        cutoff = len(self.messages) - COMPACT_KEEP_MESSAGES
+        if cutoff <= 0:
+            return
+
+        tool_names = {}
+        latest_results = {}  # Tool name -> tool_call_id of its most recent result
+        for message in self.messages:
+            for tool_call in message.get("tool_calls") or []:
+                tool_names[tool_call.id] = tool_call.function.name
+            if message["role"] == "tool":
+                latest_results[tool_names.get(message["tool_call_id"])] = message["tool_call_id"]
+        keep = set(latest_results.values())
+
+        for index in range(cutoff):
+            message = self.messages[index]
+            if message["role"] != "tool" or message["tool_call_id"] in keep:
+                continue
+            content = message["content"]
+            if len(content) > COMPACT_RESULT_CHARS:
+                message["content"] = f"[elided {len(content)} chars; tool={tool_names.get(message['tool_call_id'])}]"
+                self._recount_message(index)
+
+    def _shrink_message(self, index: int) -> bool:
+        """Truncate a tool result message in place; returns whether anything changed"""
+        message = self.messages[index]
+        content = message["content"]
+        # Results already cut down are COMPACT_RESULT_CHARS plus the marker; leave them be
+        if message["role"] != "tool" or len(content) <= COMPACT_RESULT_CHARS + len(TRUNCATED_MARKER):
+            return False
+        message["content"] = content[:COMPACT_RESULT_CHARS] + TRUNCATED_MARKER
+        self._recount_message(index)
+        return True
+
     async def initialize_tools(self, session: ClientSession) -> None:
         """Fetch and cache available tools with schemas"""
         print("📋 Initializing available tools...")
-        response = await session.list_tools()
+        response = await list_tools(session)
+        # batch_execute is plumbing for this client, not a tool for the model
+        tools = [tool for tool in response.tools if tool.name != BATCH_TOOL]
+        self._batch_supported = len(tools) < len(response.tools)
+        # Interned names let per-call lookups short-circuit on identity
         self.available_tools = [
             {
                 "type": "function",
                 "function": {
-                    "name": tool.name,
+                    "name": sys.intern(tool.name),
                     "description": tool.description or "",
                     "parameters": tool.inputSchema,
                 }
             }
-            for tool in response.tools
+            for tool in tools
         ]
+        self._tools_by_name = {t["function"]["name"]: t for t in self.available_tools}
+        self._validators = {
+            sys.intern(tool.name): _compile_validator(tool.name, tool.inputSchema)
+            for tool in tools
+        }
+        # Only tools the server marks read-only are safe to answer from cache
+        self._tool_cache.cacheable = {
+            sys.intern(tool.name) for tool in tools
+            if getattr(getattr(tool, "annotations", None), "readOnlyHint", False)
+        }
         logger.info(f"Available tools initialized: {[t['function']['name'] for t in self.available_tools]}")
         print(f"✅ Initialized {len(self.available_tools)} tools")
 
@@ -86,102 +199,162 @@ class Chat:
            stop=stop_after_attempt(RETRY_ATTEMPTS))
     async def openai_request(self, **kwargs) -> Any:
         """Make OpenAI API request with retry"""
-        print(f"🤖 Sending request to OpenAI API...")
+        logger.trace("🤖 Sending request to OpenAI API...")
         try:
             response = await self.client.chat.completions.create(**kwargs)
-            print(f"✅ Received response from OpenAI API")
+            logger.trace("✅ Received response from OpenAI API")
             return response
         except openai.OpenAIError as e:
-            print(f"❌ OpenAI API error: {str(e)}")
             logger.error(f"OpenAI API error: {str(e)}")
             raise
 
     async def _truncate_messages(self):
         """Maintain conversation history within token limits"""
-        print("📏 Checking conversation token count...")
-        # Approximate token count based on characters
-        char_count = sum(len(str(m)) for m in self.messages)
-        estimated_tokens = char_count // 4
-        
-        print(f"📊 Estimated token count: {estimated_tokens}/{MAX_TOKENS}")
+        logger.trace("📊 Current token count: {}/{}", self._total_tokens, MAX_TOKENS)
         
-        while estimated_tokens > MAX_TOKENS:
+        while self._total_tokens > MAX_TOKENS:
             if len(self.messages) > 1:
+                if self._msg_tokens[1] > MAX_TOKENS // 2:
+                    # Cut a single oversized tool result down rather than scanning history around it;
+                    # pop it as usual once shrinking stops making it smaller
+                    before = self._msg_tokens[1]
+                    if self._shrink_message(1) and self._msg_tokens[1] < before:
+                        continue
                 removed = self.messages.pop(1)
-                print(f"✂️ Truncated message: {str(removed)[:50]}...")
-                logger.warning(f"Truncated message: {str(removed)[:50]}...")
-                
-                char_count = sum(len(str(m)) for m in self.messages)
-                estimated_tokens = char_count // 4
-                print(f"📊 Updated estimated token count: {estimated_tokens}/{MAX_TOKENS}")
+                self._total_tokens -= self._msg_tokens.pop(1)
+                logger.opt(lazy=True).warning("✂️ Truncated message: {}...", lambda: str(removed)[:50])
+                logger.trace("📊 Updated token count: {}/{}", self._total_tokens, MAX_TOKENS)
             else:
-                print("⚠️ Cannot truncate further - only system message remains")
+                logger.warning("⚠️ Cannot truncate further - only system message remains")
                 break
 
-    async def process_tool_call(self, session: ClientSession, tool_call) -> dict:
-        """Execute tool with validation and error handling"""
+    async def _check_tool_call(self, tool_call) -> tuple[dict | None, dict | None]:
+        """Parse and validate a tool call; returns (error result, parsed arguments)"""
         tool_name = tool_call.function.name
-        print(f"🛠️ Executing tool: {tool_name} (ID: {tool_call.id})")
-        print(f"📥 Tool input: {tool_call.function.arguments}")
+        logger.trace("🛠️ Executing tool: {} (ID: {})", tool_name, tool_call.id)
+        logger.trace("📥 Tool input: {}", tool_call.function.arguments)
         
-        tool = next((t for t in self.available_tools if t["function"]["name"] == tool_name), None)
+        tool = self._tools_by_name.get(tool_name)
         
         if not tool:
-            print(f"❌ Tool '{tool_name}' not found")
+            logger.error("❌ Tool '{}' not found", tool_name)
             return {
                 "tool_call_id": tool_call.id,
                 "output": f"Tool '{tool_name}' not found"
-            }
+            }, None
         
         try:
-            # Parse JSON arguments
-            tool_args = json.loads(tool_call.function.arguments)
-            
-            # Validate against tool schema
-            print(f"🔍 Validating input against schema for {tool_name}...")
-            validate(instance=tool_args, schema=tool["function"]["parameters"])
-            print(f"✅ Input validation successful")
+            # Parse JSON arguments and validate against tool schema
+            arguments = tool_call.function.arguments
+            validator = self._validators.get(tool_name)
+            if len(arguments) > OFFLOAD_ARGS_BYTES:
+                # Keep large payloads from stalling concurrent tool I/O
+                tool_args = await asyncio.to_thread(_parse_tool_args, arguments, validator)
+            else:
+                tool_args = _parse_tool_args(arguments, validator)
+            return None, tool_args
             
+        except fastjsonschema.JsonSchemaValueException as ve:
+            error_msg = f"Validation error: {str(ve)}"
+            logger.error(f"Validation error for {tool_name}: {str(ve)}")
+            return {"tool_call_id": tool_call.id, "output": error_msg}, None
+        except Exception as e:
+            error_msg = f"Execution error: {str(e)}"
+            logger.error(f"Tool execution error for {tool_name}: {str(e)}")
+            return {"tool_call_id": tool_call.id, "output": error_msg}, None
+
+    async def process_tool_call(self, session: ClientSession, tool_call) -> dict:
+        """Execute tool with validation and error handling"""
+        tool_name = tool_call.function.name
+        error, tool_args = await self._check_tool_call(tool_call)
+        if error is not None:
+            return error
+        
+        cache_key = self._tool_cache.key(tool_name, tool_args)
+        if cache_key is not None and (cached := self._tool_cache.get(cache_key)) is not None:
+            logger.trace("♻️ Cached result for {}", tool_name)
+            return {"tool_call_id": tool_call.id, "output": cached}
+
+        try:
             # Execute tool
-            print(f"⚙️ Executing {tool_name}...")
             result = await session.call_tool(tool_name, cast(dict, tool_args))
             tool_result = {
                 "tool_call_id": tool_call.id,
                 "output": result.content[0].text if result.content else ""
             }
-            print(f"✅ Tool execution complete")
-            print(f"📤 Tool result: {tool_result['output'][:100]}..." if len(tool_result['output']) > 100 else f"📤 Tool result: {tool_result['output']}")
+            if cache_key is not None and not result.isError:
+                self._tool_cache.put(cache_key, tool_result["output"])
+            logger.opt(lazy=True).trace("📤 Tool result: {}", lambda: tool_result["output"][:100])
             return tool_result
             
-        except ValidationError as ve:
-            error_msg = f"Validation error: {str(ve)}"
-            print(f"❌ {error_msg}")
-            logger.error(f"Validation error for {tool_name}: {str(ve)}")
-            return {"tool_call_id": tool_call.id, "output": error_msg}
         except Exception as e:
             error_msg = f"Execution error: {str(e)}"
-            print(f"❌ {error_msg}")
             logger.error(f"Tool execution error for {tool_name}: {str(e)}")
             return {"tool_call_id": tool_call.id, "output": error_msg}
 
+    async def process_tool_calls(self, session: ClientSession, tool_calls: list) -> list[dict]:
+        """Execute tool calls, sending several in one batch_execute round-trip"""
+        if len(tool_calls) < 2 or not self._batch_supported:
+            # Report each tool as it finishes rather than waiting on the slowest
+            tool_names = {call.id: call.function.name for call in tool_calls}
+            results = {}
+            for next_result in asyncio.as_completed(
+                [self.process_tool_call(session, tool_call) for tool_call in tool_calls]
+            ):
+                result = await next_result
+                logger.info("✔ {} done", tool_names[result["tool_call_id"]])
+                results[result["tool_call_id"]] = result
+            return [results[tool_call.id] for tool_call in tool_calls]
+
+        results = {}
+        batch = []
+        checks = await asyncio.gather(*[self._check_tool_call(tool_call) for tool_call in tool_calls])
+        for tool_call, (error, tool_args) in zip(tool_calls, checks):
+            if error is not None:
+                results[tool_call.id] = error
+                continue
+            cache_key = self._tool_cache.key(tool_call.function.name, tool_args)
+            if cache_key is not None and (cached := self._tool_cache.get(cache_key)) is not None:
+                logger.trace("♻️ Cached result for {}", tool_call.function.name)
+                results[tool_call.id] = {"tool_call_id": tool_call.id, "output": cached}
+            else:
+                batch.append((tool_call, tool_args, cache_key))
+
+        if batch:
+            logger.trace("📦 Batching {} tool calls into one request...", len(batch))
+            try:
+                response = await session.call_tool(BATCH_TOOL, {
+                    "calls": [{"name": call.function.name, "arguments": args} for call, args, _ in batch]
+                })
+                outputs = orjson.loads(response.content[0].text)
+                for (tool_call, _, cache_key), output in zip(batch, outputs, strict=True):
+                    results[tool_call.id] = {"tool_call_id": tool_call.id, "output": output["content"]}
+                    if cache_key is not None and not output["is_error"]:
+                        self._tool_cache.put(cache_key, output["content"])
+            except Exception as e:
+                error_msg = f"Execution error: {str(e)}"
+                logger.error(f"Batch execution error: {str(e)}")
+                for tool_call, _, _ in batch:
+                    results[tool_call.id] = {"tool_call_id": tool_call.id, "output": error_msg}
+
+        return [results[tool_call.id] for tool_call in tool_calls]
+
     async def process_query(self, session: ClientSession, query: str) -> None:
         """Process user query with tool support"""
-        print("\n" + "="*50)
-        print(f"📝 Processing query: {query}")
-        self.messages.append({"role": "user", "content": query})
+        logger.trace("📝 Processing query: {}", query)
+        self._append_message({"role": "user", "content": query})
         
         iteration = 0
         while True:
             if iteration > 0:
-                print(f"\n🔄 Iteration {iteration+1} - Processing tool results...")
+                logger.trace("🔄 Iteration {} - Processing tool results...", iteration + 1)
             iteration += 1
             
             try:
                 # Get OpenAI response
-                print(f"🧠 Thinking...")
                 res = await self.openai_request(
                     model=MODEL,
-                    messages=[{"role": "system", "content": self.system_prompt}] + self.messages,
+                    messages=self.messages,
                     max_tokens=4096,
                     tools=self.available_tools if self.available_tools else None,
                     tool_choice="auto",
@@ -190,11 +363,11 @@ class Chat:
                 assistant_message = res.choices[0].message
             except Exception as e:
                 error_msg = f"System error: Failed to get response ({str(e)})"
-                self.messages.append({
+                self._append_message({
                     "role": "assistant", 
                     "content": error_msg
                 })
-                print(f"❌ {error_msg}")
+                logger.error(error_msg)
                 break
 
             # Store assistant response in history
@@ -206,7 +379,7 @@ class Chat:
             if assistant_message.tool_calls:
                 assistant_message_dict["tool_calls"] = assistant_message.tool_calls
             
-            self.messages.append(assistant_message_dict)
+            self._append_message(assistant_message_dict)
 
             # Print text response
             if assistant_message.content:
@@ -215,33 +388,27 @@ class Chat:
 
             # Process tool calls if any
             if not assistant_message.tool_calls:
-                print("✅ Query complete - no tools needed")
+                logger.trace("✅ Query complete - no tools needed")
                 break
             else:
                 tool_calls = assistant_message.tool_calls
-                print(f"\n🛠️ Tools requested: {', '.join([call.function.name for call in tool_calls])}")
+                logger.info("🛠️ Tools requested: {}", ", ".join(call.function.name for call in tool_calls))
 
                 # Process tools in parallel
-                print("⚙️ Executing tools in parallel...")
-                tool_results = await asyncio.gather(
-                    *[self.process_tool_call(session, tool_call) for tool_call in tool_calls]
-                )
+                tool_results = await self.process_tool_calls(session, tool_calls)
                 
                 # Add tool results to messages
                 for result in tool_results:
-                    self.messages.append({
+                    self._append_message({
                         "role": "tool",
                         "tool_call_id": result["tool_call_id"],
                         "content": result["output"]
                     })
 
-                print("\n📤 Sending tool results back to OpenAI...")
-
             # Maintain token window
+            self._compact_history()
             await self._truncate_messages()
 
-        print("="*50 + "\n")
-
     async def chat_loop(self, session: ClientSession):
         """Main chat interface"""
         print("\n🚀 Starting chat interface")
@@ -265,17 +432,22 @@ class Chat:
                 print(f"❌ Chat error: {str(e)}")
                 print("Sorry, an error occurred. Please try again.")
 
+    async def attach(self, session: ClientSession) -> None:
+        """Prepare this chat to run queries over a session the caller already holds"""
+        await self.initialize_tools(session)
+
     async def run(self):
         """Main entry point"""
         print("🔌 Establishing connection to server...")
-        async with stdio_client(server_params) as (read, write):
-            print("✅ Connection established")
-            async with ClientSession(read, write) as session:
-                print("🔄 Initializing session...")
-                await session.initialize()
-                print("✅ Session initialized")
-                await self.chat_loop(session)
-                print("👋 Session ended")
+        session = await get_session(server_params)
+        print("✅ Session initialized")
+        try:
+            await self.chat_loop(session)
+        finally:
+            if release_session() == 0:
+                # No one else holds the session, so stop the server before the loop shuts down
+                await close_session()
+        print("👋 Session ended")
 
 if __name__ == "__main__":
     print("🚀 Starting chat agent")
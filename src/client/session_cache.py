@@ -0,0 +1,95 @@
+# Shared MCP server session for chat clients
+import asyncio
+import weakref
+
+from loguru import logger
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.types import ListToolsResult
+
+SESSION_IDLE_TIMEOUT = 300  # Seconds an unused session stays open before the server is stopped
+
+_lock: asyncio.Lock | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+_session: ClientSession | None = None
+_owner: asyncio.Task | None = None
+_closing: asyncio.Event | None = None
+_idle_timer: asyncio.TimerHandle | None = None
+_users = 0
+_tools: "weakref.WeakKeyDictionary[ClientSession, ListToolsResult]" = weakref.WeakKeyDictionary()
+
+
+async def _serve(server_params: StdioServerParameters, ready: asyncio.Future, closing: asyncio.Event) -> None:
+    """Own the stdio transport; it must be entered and exited in the same task"""
+    global _session
+    try:
+        async with stdio_client(server_params) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                ready.set_result(session)
+                await closing.wait()
+    except Exception as e:
+        if not ready.done():
+            ready.set_exception(e)
+        else:
+            logger.error(f"MCP session closed unexpectedly: {str(e)}")
+    finally:
+        if not ready.done():
+            ready.cancel()
+        if _owner is asyncio.current_task():
+            _session = None
+        logger.debug("MCP session closed")
+
+
+async def get_session(server_params: StdioServerParameters) -> ClientSession:
+    """Return the shared session, starting the server on first use"""
+    global _lock, _loop, _session, _owner, _closing, _idle_timer, _users
+    loop = asyncio.get_running_loop()
+    if loop is not _loop:
+        # Sessions and locks are bound to the loop that created them
+        _lock, _loop, _session, _owner, _closing, _idle_timer, _users = asyncio.Lock(), loop, None, None, None, None, 0
+
+    async with _lock:
+        if _idle_timer is not None:
+            _idle_timer.cancel()
+            _idle_timer = None
+        if _closing is not None and _closing.is_set() and not _owner.done():
+            # The old session is shutting down; let it finish rather than hand it out
+            await asyncio.wait({_owner})
+        if _session is None or _owner.done() or _closing.is_set():
+            logger.debug("Starting MCP server session")
+            ready = loop.create_future()
+            _closing = asyncio.Event()
+            _owner = asyncio.create_task(_serve(server_params, ready, _closing))
+            _session = await ready
+        _users += 1
+        return _session
+
+
+def release_session() -> int:
+    """Release a session from get_session; it closes after SESSION_IDLE_TIMEOUT unused.
+    Returns how many callers still hold it."""
+    global _idle_timer, _users
+    _users = max(_users - 1, 0)
+    if _users == 0 and _closing is not None and _loop is not None:
+        _idle_timer = _loop.call_later(SESSION_IDLE_TIMEOUT, _closing.set)
+    return _users
+
+
+async def close_session() -> None:
+    """Stop the shared server session immediately"""
+    global _idle_timer
+    if _idle_timer is not None:
+        _idle_timer.cancel()
+        _idle_timer = None
+    if _closing is not None:
+        _closing.set()
+    if _owner is not None:
+        await _owner
+
+
+async def list_tools(session: ClientSession) -> ListToolsResult:
+    """List a session's tools, fetching them from the server once per session"""
+    if session not in _tools:
+        _tools[session] = await session.list_tools()
+    return _tools[session]
@@ -0,0 +1,44 @@
+# Bounded TTL cache of read-only tool results
+import time
+from collections import OrderedDict
+from typing import Any
+
+import orjson
+
+TOOL_CACHE_SIZE = 128
+TOOL_CACHE_TTL = 60  # Seconds a cached result stays valid
+
+
+class ToolCache:
+    """LRU cache of tool results keyed on (tool name, canonicalized arguments)"""
+
+    def __init__(self, max_size: int = TOOL_CACHE_SIZE, ttl: float = TOOL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cacheable: set[str] = set()
+        self._entries: OrderedDict[tuple[str, bytes], tuple[float, str]] = OrderedDict()
+
+    def key(self, name: str, arguments: Any) -> tuple[str, bytes] | None:
+        """Cache key for a call, or None if the tool may have side effects"""
+        if name not in self.cacheable:
+            return None
+        return name, orjson.dumps(arguments, option=orjson.OPT_SORT_KEYS)
+
+    def get(self, key: tuple[str, bytes]) -> str | None:
+        """Return a fresh cached result, evicting it if it has expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, content = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return content
+
+    def put(self, key: tuple[str, bytes], content: str) -> None:
+        """Store a result, dropping the least recently used entry when full"""
+        self._entries[key] = (time.monotonic(), content)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
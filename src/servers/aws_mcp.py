@@ -1,8 +1,10 @@
 # AWS MCP SERVER
 
 from fastmcp import FastMCP
+from fastmcp.exceptions import ToolError
+import asyncio
 import boto3
-import json
+import orjson
 from datetime import datetime, timezone
 
 # Create a CloudWatch Logs client
@@ -16,28 +18,32 @@ lambda_client = boto3.client('lambda', region_name='us-east-1')
 cloudwatch_client = boto3.client('cloudwatch', region_name='us-east-1')
 
 # Lambda tools
-@aws_mcp.tool()
-def list_lambda_functions(region: str) -> str:
+# boto3 is synchronous; calls run in worker threads so concurrent tool calls overlap
+@aws_mcp.tool(annotations={"readOnlyHint": True})
+async def list_lambda_functions(region: str) -> str:
     """List all Lambda functions in the specified region"""
-    response = lambda_client.list_functions()
+    response = await asyncio.to_thread(lambda_client.list_functions)
     functions = [f['FunctionName'] for f in response['Functions']]
     return f"Lambda functions in {region}: {functions}"
 
 @aws_mcp.tool()
-def invoke_lambda_function(function_name: str, payload: str) -> str:
+async def invoke_lambda_function(function_name: str, payload: str) -> str:
     """Invoke a Lambda function with the given payload"""
-    response = lambda_client.invoke(FunctionName=function_name, Payload=payload)
-    return f"Invocation result: {response['Payload'].read().decode()}"
+    response = await asyncio.to_thread(lambda_client.invoke, FunctionName=function_name, Payload=payload)
+    result = await asyncio.to_thread(response['Payload'].read)
+    return f"Invocation result: {result.decode()}"
 
 # CloudWatch tools
-@aws_mcp.tool()
-def get_cloudwatch_logs(
+@aws_mcp.tool(annotations={"readOnlyHint": True})
+async def get_cloudwatch_logs(
     log_group_name: str,
     start_time: int = None,
     end_time: int = None,
     hours_back: int = None,
     filter_pattern: str = None,
-    log_stream_names: list = None
+    log_stream_names: list = None,
+    max_events: int = 1000,
+    limit_per_call: int = 10000
 ) -> str:
     """
     Get log events from the specified CloudWatch log group with optional time filters and patterns.
@@ -48,7 +54,10 @@ def get_cloudwatch_logs(
     :param hours_back: Number of hours back from now to fetch logs (alternative to start_time).
     :param filter_pattern: Optional filter pattern for log messages (e.g., "ERROR").
     :param log_stream_names: Optional list of log stream names to filter by.
-    :return: A JSON string containing the list of log events or an error message.
+    :param max_events: Maximum number of log events to return (pagination stops once reached).
+    :param limit_per_call: Maximum events per filter_log_events page (API maximum is 10000).
+    :return: A JSON string containing the list of log events.
+    :raises ToolError: If the logs could not be fetched.
     """
     try:
         # Determine start_time and end_time
@@ -71,18 +80,20 @@ def get_cloudwatch_logs(
         all_logs = []
         next_token = None
         
-        # Loop to handle pagination
-        while True:
+        # Loop to handle pagination, stopping once enough events are collected
+        while len(all_logs) < max_events:
             kwargs = {
                 'logGroupName': log_group_name,
                 'startTime': start_time,
                 'endTime': end_time,
-                'filterPattern': filter_pattern,
+                'limit': min(limit_per_call, max_events - len(all_logs)),
                 # 'logStreamNames': log_stream_names
             }
+            if filter_pattern:
+                kwargs['filterPattern'] = filter_pattern
             if next_token:
                 kwargs['nextToken'] = next_token
-            response = client.filter_log_events(**kwargs)
+            response = await asyncio.to_thread(client.filter_log_events, **kwargs)
             all_logs.extend(response.get('events', []))
             if 'nextToken' in response:
                 next_token = response['nextToken']
@@ -90,17 +101,18 @@ def get_cloudwatch_logs(
                 break
         
         # Return logs as JSON
-        return json.dumps(all_logs)
+        return orjson.dumps(all_logs[:max_events]).decode()
     
     except Exception as e:
-        # Return error as JSON
-        return json.dumps({"error": str(e)})
+        # Raise so the result is flagged isError; clients never cache error results
+        raise ToolError(f"Failed to fetch CloudWatch logs: {str(e)}") from e
 
 
 @aws_mcp.tool()
-def create_cloudwatch_alarm(metric_name: str, threshold: float) -> str:
+async def create_cloudwatch_alarm(metric_name: str, threshold: float) -> str:
     """Create a CloudWatch alarm for the specified metric"""
-    response = cloudwatch_client.put_metric_alarm(
+    response = await asyncio.to_thread(
+        cloudwatch_client.put_metric_alarm,
         AlarmName=f"{metric_name}_alarm",
         ComparisonOperator='GreaterThanThreshold',
         EvaluationPeriods=1,
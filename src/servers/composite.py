@@ -1,6 +1,14 @@
 # COMPOSITE MCP SERVER
 
-from fastmcp import FastMCP
+from fastmcp import FastMCP, Client
+from fastmcp.tools import Tool
+import asyncio
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -11,15 +19,73 @@ from servers.aws_mcp import aws_mcp
 
 mcp = FastMCP("Composite")
 
+mounts = {
+    "postgres": postgres_mcp,
+    "couchdb": couchdb_mcp,
+    "aws": aws_mcp,
+}
+
 # Mount sub-apps with prefixes
-mcp.mount("postgres", postgres_mcp) 
-mcp.mount("couchdb", couchdb_mcp) 
-mcp.mount('aws', aws_mcp)
+for prefix, server in mounts.items():
+    mcp.mount(prefix, server)
+
+# Flat "<prefix>_<tool>" -> Tool index over the mounted sub-apps, built on first use
+_flat_tools: dict[str, Tool] = {}
+
+
+async def _tool_index() -> dict[str, Tool]:
+    """Index mounted tools by their prefixed name so batch dispatch is one dict lookup"""
+    if not _flat_tools:
+        for prefix, server in mounts.items():
+            for name, tool in (await server.get_tools()).items():
+                _flat_tools[f"{prefix}_{name}"] = tool
+    return _flat_tools
 
 @mcp.tool()
 def ping(): 
     return "Composite OK"
 
 
+@mcp.tool()
+async def batch_execute(calls: list[dict]) -> str:
+    """
+    Execute several tool calls concurrently in a single request.
+
+    Args:
+        calls (list[dict]): Tool calls as {"name": ..., "arguments": {...}}.
+
+    Returns:
+        str: JSON array of {"content": ..., "is_error": ...}, in call order.
+    """
+    tools = await _tool_index()
+
+    async def run(client: Client | None, call: dict) -> dict:
+        arguments = call.get("arguments") or {}
+        try:
+            tool = tools.get(call["name"])
+            if tool is not None:
+                # Mounted tool: run it directly instead of re-entering MCP dispatch
+                content = await tool.run(arguments)
+                return {"content": content[0].text if content else "", "is_error": False}
+            result = await client.call_tool_mcp(call["name"], arguments)
+            return {
+                "content": result.content[0].text if result.content else "",
+                "is_error": result.isError,
+            }
+        except Exception as e:
+            return {"content": f"Error: {str(e)}", "is_error": True}
+
+    if all(call["name"] in tools for call in calls):
+        results = await asyncio.gather(*[run(None, call) for call in calls])
+    else:
+        # Fall back to full dispatch for tools outside the index (e.g. ping)
+        async with Client(mcp) as client:
+            results = await asyncio.gather(*[run(client, call) for call in calls])
+    return orjson.dumps(results).decode()
+
+
 if __name__ == "__main__":
-    mcp.run()
\ No newline at end of file
+    if uvloop is not None:
+        # FastMCP creates the loop itself, so swap the policy it creates it from
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    mcp.run()
@@ -1,12 +1,19 @@
 # COUCHDB MCP SERVER
 
 import os
-import psycopg2
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
 import couchdb
+import couchdb.http
+import couchdb.json
+import orjson
 
 from loguru import logger
 from fastmcp import FastMCP
 from dotenv import load_dotenv
+from prompts import MOBILIZATION_PROMPT, mobilization_prompts
 
 load_dotenv()
 
@@ -18,11 +25,106 @@ COUCH_PORT = os.getenv("COUCH_PORT", "5984")
 
 couch_url = f"http://{COUCH_USER}:{COUCH_PASSWORD}@{COUCH_HOST}:{COUCH_PORT}"
 
+# Decode CouchDB responses with orjson rather than the stdlib json module
+couchdb.json.use(decode=orjson.loads, encode=lambda obj: orjson.dumps(obj).decode())
+
+# One server handle for the process; its session keeps HTTP connections alive between calls
+_couch = couchdb.Server(couch_url, session=couchdb.http.Session(retry_delays=[1]))
+
+COUCH_DB_TTL = 300  # Seconds a database is trusted to exist before it is probed again
+_dbs: dict[str, tuple[float, couchdb.Database]] = {}
+
+
+def _get_db(db_name: str) -> couchdb.Database | None:
+    """Return a database handle, probing for its existence at most once per COUCH_DB_TTL"""
+    cached = _dbs.get(db_name)
+    if cached is not None and time.monotonic() - cached[0] <= COUCH_DB_TTL:
+        return cached[1]
+    if db_name not in _couch:
+        _dbs.pop(db_name, None)
+        return None
+    db = _couch[db_name]
+    _dbs[db_name] = (time.monotonic(), db)
+    return db
+
+
+COUCH_INDEX_HINTS = 256  # Query shapes whose chosen index is remembered
+COUCH_INDEX_HINT_TTL = 300  # Seconds a learned index is trusted before _explain is asked again
+_index_hints: OrderedDict[tuple[str, bytes], tuple[float, list[str] | None]] = OrderedDict()
+
+
+def _query_shape(value: Any) -> Any:
+    """Reduce a Mango query to its fields and operators, dropping the compared values"""
+    if isinstance(value, dict):
+        return {key: _query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_query_shape(item) for item in value]
+    return None
+
+
+def _hint_key(db_name: str, body: dict) -> tuple[str, bytes]:
+    """Index hint cache key for a query: its selector's shape and its sort"""
+    # Sort entries are field names and directions, which decide the index, so they are kept as given
+    shape = {"selector": _query_shape(body.get("selector")), "sort": body.get("sort")}
+    return db_name, orjson.dumps(shape, option=orjson.OPT_SORT_KEYS)
+
+
+async def _index_hint(db: couchdb.Database, db_name: str, body: dict) -> list[str] | None:
+    """Index CouchDB picks for a query's shape, asking _explain at most once per COUCH_INDEX_HINT_TTL"""
+    key = _hint_key(db_name, body)
+    cached = _index_hints.get(key)
+    if cached is not None and time.monotonic() - cached[0] <= COUCH_INDEX_HINT_TTL:
+        _index_hints.move_to_end(key)
+        return cached[1]
+
+    _, _, plan = await asyncio.to_thread(db.resource.post_json, "_explain", body)
+    index = plan.get("index", {})
+    # The "special" index is _all_docs, a full scan; there is nothing worth pinning
+    hint = [index["ddoc"], index["name"]] if index.get("ddoc") and index.get("type") != "special" else None
+    _index_hints[key] = (time.monotonic(), hint)
+    _index_hints.move_to_end(key)
+    if len(_index_hints) > COUCH_INDEX_HINTS:
+        _index_hints.popitem(last=False)
+    return hint
+
+
+_inflight: dict[tuple, asyncio.Future] = {}
+
+
+async def _coalesced(key: tuple, run: Callable[[], Awaitable[Any]]) -> Any:
+    """Share one in-flight result between identical concurrent reads"""
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(run())
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller giving up doesn't cancel the request for the others
+    return await asyncio.shield(task)
+
 # Create an MCP server
 couchdb_mcp = FastMCP("Data Support Agent")
 
+
+async def _bulk_write(db: couchdb.Database, operation: str, docs: list[dict]) -> str:
+    """Create, update or delete many documents with a single _bulk_docs request"""
+    if operation not in ("create", "update", "delete"):
+        return f"Error: Operation '{operation}' does not accept a list of documents."
+    if operation in ("update", "delete") and not all("_id" in doc and "_rev" in doc for doc in docs):
+        return f"Error: Every document needs '_id' and '_rev' for bulk {operation}."
+    if operation == "delete":
+        docs = [{"_id": doc["_id"], "_rev": doc["_rev"], "_deleted": True} for doc in docs]
+
+    results = await asyncio.to_thread(db.update, docs)
+    return orjson.dumps([
+        {"ok": True, "id": doc_id, "rev": rev_or_error} if success
+        else {"ok": False, "id": doc_id, "error": str(rev_or_error)}
+        for success, doc_id, rev_or_error in results
+    ]).decode()
+
+
 @couchdb_mcp.tool()
-def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None) -> str:
+async def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict | list[dict] = None,
+                limit: int = 100, bookmark: str = None, use_index: str | list[str] = None,
+                rev: str = None) -> str:
     """
     Perform CRUD operations on CouchDB documents in a specific database.
 
@@ -31,37 +133,78 @@ def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation:
         doc_id (str): Document ID to fetch, update, or delete a specific document.
         query (dict): Mango query to list documents (if doc_id is not provided).
         operation (str): The type of operation to perform. Options: "create", "read", "update", "delete".
-        data (dict): The data to use for create or update operations.
+        data (dict | list[dict]): The data to use for create or update operations. A list of
+            documents is written in one bulk request; each needs '_id' and '_rev' to update or delete.
+        limit (int): Maximum number of documents a Mango query returns per page.
+        bookmark (str): Bookmark from a previous page of the same Mango query, to fetch the next page.
+        use_index (str | list[str]): Design document, or [design document, index name], for a Mango
+            query to use. Defaults to the index CouchDB chose the last time a query of the same shape ran.
+        rev (str): Current revision of the document to update. When given, the document is replaced
+            with 'data' in a single request instead of being fetched and merged first.
 
     Returns:
-        str: The result of the operation.
+        str: The result of the operation. Reads and bulk writes return JSON; Mango queries return
+            {"docs": [...], "bookmark": ...} and bulk writes one {"ok", "id", "rev" or "error"} per document.
     """
-    logger.info(f"Performing operation '{operation}' on CouchDB database '{db_name}' - doc_id: {doc_id}, query: {query}, data: {data}")
+    # Bulk payloads can be huge; log their size rather than formatting every document
+    logger.info(
+        "Performing operation '{}' on CouchDB database '{}' - doc_id: {}, query: {}, data: {}",
+        operation, db_name, doc_id, query,
+        f"[{len(data)} documents]" if isinstance(data, list) else data,
+    )
 
     try:
-        # Connect to CouchDB
-        couch = couchdb.Server(couch_url)
-
         # Check if the database exists
-        if db_name not in couch:
+        # couchdb-python is blocking, so each request runs in a worker thread
+        db = await asyncio.to_thread(_get_db, db_name)
+        if db is None:
             return f"Error: Database '{db_name}' does not exist."
 
-        db = couch[db_name]
+        if isinstance(data, list):
+            return await _bulk_write(db, operation, data)
 
         if operation == "read":
             if doc_id:
                 # Fetch a specific document by ID
                 try:
-                    doc = db[doc_id]
-                    return str(doc)
+                    # Identical reads already in flight share one request
+                    doc = await _coalesced(
+                        ("doc", db_name, doc_id), lambda: asyncio.to_thread(db.__getitem__, doc_id)
+                    )
+                    return orjson.dumps(doc).decode()
                 except couchdb.ResourceNotFound:
+                    _dbs.pop(db_name, None)  # The database itself may be gone; re-probe next time
                     return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
             else:
-                # Use mango query to list documents
+                # Use mango query to list documents, one page at a time
+                hinted = False
                 try:
-                    results = db.find(query)
-                    return "\n".join(str(doc) for doc in results)
+                    body = dict(query or {"selector": {}})
+                    body.setdefault("limit", limit)
+                    if bookmark:
+                        body["bookmark"] = bookmark
+                    if use_index:
+                        body["use_index"] = use_index
+                    elif "use_index" not in body and (hint := await _index_hint(db, db_name, body)):
+                        body["use_index"] = hint
+                        hinted = True
+                    _, _, results = await _coalesced(
+                        ("_find", db_name, orjson.dumps(body, option=orjson.OPT_SORT_KEYS)),
+                        lambda: asyncio.to_thread(db.resource.post_json, "_find", body),
+                    )
+                    if hinted and "warning" in results:
+                        # CouchDB warns when the pinned index is gone or no longer fits; learn it again
+                        _index_hints.pop(_hint_key(db_name, body), None)
+                    return orjson.dumps({
+                        "docs": results.get("docs", []),
+                        "bookmark": results.get("bookmark"),
+                    }).decode()
+                except couchdb.ResourceNotFound:
+                    _dbs.pop(db_name, None)
+                    return f"Error: Database '{db_name}' does not exist."
                 except Exception as e:
+                    if hinted:
+                        _index_hints.pop(_hint_key(db_name, body), None)
                     logger.error(f"Error querying CouchDB: {str(e)}")
                     return f"Error: {str(e)}"
 
@@ -69,19 +212,26 @@ def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation:
             if not data:
                 return "Error: 'data' is required for create operation."
             # Create a new document
-            doc_id, doc_rev = db.save(data)
+            doc_id, doc_rev = await asyncio.to_thread(db.save, data)
             return f"Document created with ID: {doc_id} and revision: {doc_rev}"
 
         elif operation == "update":
             if not doc_id or not data:
                 return "Error: 'doc_id' and 'data' are required for update operation."
-            # Fetch the existing document
             try:
-                doc = db[doc_id]
-                doc.update(data)
-                db.save(doc)
+                if rev:
+                    # The caller knows the revision, so write straight away without a GET
+                    doc = {**data, "_id": doc_id, "_rev": rev}
+                else:
+                    # Fetch the existing document
+                    doc = await asyncio.to_thread(db.__getitem__, doc_id)
+                    doc.update(data)
+                await asyncio.to_thread(db.save, doc)
                 return f"Document with ID '{doc_id}' updated successfully."
+            except couchdb.ResourceConflict:
+                return f"Error: Document with ID '{doc_id}' has a newer revision; fetch it and retry."
             except couchdb.ResourceNotFound:
+                _dbs.pop(db_name, None)
                 return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
 
         elif operation == "delete":
@@ -89,10 +239,11 @@ def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation:
                 return "Error: 'doc_id' is required for delete operation."
             # Fetch the existing document
             try:
-                doc = db[doc_id]
-                db.delete(doc)
+                doc = await asyncio.to_thread(db.__getitem__, doc_id)
+                await asyncio.to_thread(db.delete, doc)
                 return f"Document with ID '{doc_id}' deleted successfully."
             except couchdb.ResourceNotFound:
+                _dbs.pop(db_name, None)
                 return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
 
         else:
@@ -106,4 +257,4 @@ def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation:
 
 @couchdb_mcp.prompt()
 def mobilization_prompt(previous_membership: str, current_membership: str) -> str:
-    return f"Please review this location mobilized from {previous_membership} to {current_membership}"
+    return MOBILIZATION_PROMPT.format(previous=previous_membership, current=current_membership)
@@ -1,12 +1,19 @@
 # POSTGRES MCP SERVER
 
 import os
-import psycopg2
-import couchdb
+import uuid
+import asyncio
+from typing import Any, Awaitable, Callable
+import orjson
+import psycopg
+import psycopg_pool
+from psycopg import sql as pg_sql
+from psycopg.rows import dict_row
 
 from loguru import logger
 from fastmcp import FastMCP
 from dotenv import load_dotenv
+from prompts import MOBILIZATION_PROMPT, mobilization_prompts
 
 load_dotenv()
 
@@ -18,36 +25,177 @@ DB_HOST = os.getenv("DB_HOST")
 
 postgres_url = f"postgresql://{PG_USER}:{PG_PASSWORD}@{DB_HOST}/{PG_DB}"
 
+PG_POOL_MIN = 2
+PG_POOL_MAX = 16
+PG_PREPARE_THRESHOLD = 2  # Executions of the same SQL text before psycopg prepares it
+PG_PREPARED_MAX = 256  # Prepared statements kept per connection
+PG_FETCH_SIZE = 10_000  # Rows per round-trip when streaming from a server-side cursor
+
+_pool: psycopg_pool.AsyncConnectionPool | None = None
+_pool_lock = asyncio.Lock()
+
+
+async def _configure_connection(conn: psycopg.AsyncConnection) -> None:
+    """Set per-connection options when the pool opens a connection"""
+    conn.prepared_max = PG_PREPARED_MAX
+
+
+async def _reset_connection(conn: psycopg.AsyncConnection) -> None:
+    """Clear per-call options before the pool hands a connection out again"""
+    await conn.set_read_only(False)
+
+
+async def get_pool() -> psycopg_pool.AsyncConnectionPool:
+    """Return the shared connection pool, connecting on first use"""
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            # An async pool has to be opened inside the running event loop
+            pool = psycopg_pool.AsyncConnectionPool(
+                kwargs={
+                    "user": PG_USER,
+                    "password": PG_PASSWORD,
+                    "host": DB_HOST,
+                    "dbname": PG_DB,
+                    # Repeated statements skip Parse/Plan once prepared on a connection
+                    "prepare_threshold": PG_PREPARE_THRESHOLD,
+                    "row_factory": dict_row,
+                },
+                configure=_configure_connection,
+                reset=_reset_connection,
+                min_size=PG_POOL_MIN,
+                max_size=PG_POOL_MAX,
+                open=False,
+            )
+            await pool.open()
+            _pool = pool
+        return _pool
+
+
+async def _format_result(cursor: psycopg.AsyncCursor) -> str:
+    """Render a finished statement's rows as a JSON array, or its affected row count"""
+    if cursor.description:
+        # default=str covers dates, decimals and UUIDs orjson can't encode natively
+        return orjson.dumps(await cursor.fetchall(), default=str).decode()
+    return f"Query executed successfully. Rows affected: {cursor.rowcount}"
+
+
+def _can_coalesce(sql: str) -> bool:
+    """Whether a statement may share its result with identical concurrent calls"""
+    lowered = sql.lstrip().lower()
+    # Advisory locks are allowed in read-only transactions, so they are excluded by name
+    return lowered[:6] == "select" and "pg_advisory" not in lowered
+
+
+async def _stream_rows(conn: psycopg.AsyncConnection, sql: str, params: tuple | None) -> str:
+    """Fetch a SELECT through a named server-side cursor in bounded chunks"""
+    async with conn.cursor(name=f"q_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = PG_FETCH_SIZE
+        # The query is wrapped in DECLARE, which a trailing semicolon would end early
+        await cursor.execute(sql.strip().rstrip(";"), params)
+        chunks = []
+        while True:
+            rows = await cursor.fetchmany(PG_FETCH_SIZE)
+            if rows:
+                # Encode each chunk's rows and splice them into one JSON array
+                chunks.append(orjson.dumps(rows, default=str)[1:-1])
+            # A short chunk is the last one; don't spend a round-trip on an empty FETCH
+            if len(rows) < PG_FETCH_SIZE:
+                break
+        return (b"[" + b",".join(chunks) + b"]").decode()
+
+
+_inflight: dict[tuple, asyncio.Future] = {}
+
+
+async def _coalesced(key: tuple, run: Callable[[], Awaitable[Any]]) -> Any:
+    """Share one in-flight result between identical concurrent reads"""
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(run())
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller giving up doesn't cancel the request for the others
+    return await asyncio.shield(task)
+
 # Create an MCP server
 postgres_mcp = FastMCP("Data Support Agent")
 
 @postgres_mcp.tool("query_postgres")
-def query_pg(sql: str) -> str:
-    """Execute SQL queries safely"""
+async def query_pg(sql: str, params: list | None = None, stream: bool = False) -> str:
+    """Execute SQL queries safely, binding params to %s placeholders; stream=True fetches a large SELECT in chunks"""
     logger.info(f"Executing SQL query: {sql}")
-    conn = psycopg2.connect(
-        user=PG_USER,
-        password=PG_PASSWORD,
-        host=DB_HOST,
-        database=PG_DB
+    # Bound values keep the SQL text identical across calls, so its prepared plan is reused
+    params = tuple(params) if params else None
+    try:
+        if _can_coalesce(sql):
+            try:
+                # Identical reads already in flight share one round-trip. The shared run is
+                # read-only, so a SELECT with side effects fails instead of sharing its result
+                return await _coalesced(
+                    (sql, orjson.dumps(params), stream),
+                    lambda: _run_query(sql, params, stream, read_only=True),
+                )
+            except psycopg.errors.ReadOnlySqlTransaction:
+                pass  # e.g. nextval() or FOR UPDATE: every caller runs it separately
+        return await _run_query(sql, params, stream)
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+async def _run_query(sql: str, params: tuple | None, stream: bool, read_only: bool = False) -> str:
+    # The pool commits on success and rolls back on error before reusing the connection
+    async with (await get_pool()).connection() as conn:
+        if read_only:
+            await conn.set_read_only(True)  # Applied by the BEGIN; the pool's reset clears it
+        # Server-side cursors are opt-in: they cost DECLARE/CLOSE round-trips and are never prepared
+        if stream:
+            return await _stream_rows(conn, sql, params)
+        return await _format_result(await conn.execute(sql, params))
+
+
+@postgres_mcp.tool("query_postgres_batch")
+async def query_pg_batch(statements: list[str], params: list[list | None] | None = None) -> str:
+    """Execute several SQL statements in one round-trip; params[i], if given, binds statements[i]"""
+    logger.info(f"Executing {len(statements)} SQL statements in a pipeline")
+    if params is None:
+        params = [None] * len(statements)
+    elif len(params) != len(statements):
+        return f"Error: Got {len(params)} parameter lists for {len(statements)} statements."
+    try:
+        async with (await get_pool()).connection() as conn:
+            # Statements are sent without waiting on each other and flushed on pipeline exit;
+            # they commit together once, or all roll back if any of them fails
+            async with conn.transaction(), conn.pipeline():
+                cursors = [
+                    await conn.execute(statement, tuple(values) if values else None)
+                    for statement, values in zip(statements, params)
+                ]
+            return "\n\n".join([
+                f"[{i}] {await _format_result(cursor)}" for i, cursor in enumerate(cursors, 1)
+            ])
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+@postgres_mcp.tool("bulk_insert_postgres")
+async def bulk_insert_pg(table: str, columns: list[str], rows: list[list]) -> str:
+    """Insert many rows at once with COPY; table may be schema-qualified"""
+    logger.info(f"Copying {len(rows)} rows into {table}")
+    copy_sql = pg_sql.SQL("COPY {} ({}) FROM STDIN").format(
+        pg_sql.Identifier(*table.split(".")),
+        pg_sql.SQL(", ").join(pg_sql.Identifier(column) for column in columns),
     )
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        
-        # Check if the query returns results
-        if cursor.description:
-            result = cursor.fetchall()
-            return "\n".join(str(row) for row in result)
-        else:
-            conn.commit()
-            return f"Query executed successfully. Rows affected: {cursor.rowcount}"
+        # All rows stream in one COPY and commit together
+        async with (await get_pool()).connection() as conn, conn.cursor() as cursor:
+            async with cursor.copy(copy_sql) as copy:
+                for row in rows:
+                    await copy.write_row(row)
+            return f"Rows inserted successfully. Rows affected: {cursor.rowcount}"
     except Exception as e:
         return f"Error: {str(e)}"
-    finally:
-        conn.close()
 
 
 @postgres_mcp.prompt()
 def mobilization_prompt(previous_membership: str, current_membership: str) -> str:
-    return f"Please review this location mobilized from {previous_membership} to {current_membership}"
+    return MOBILIZATION_PROMPT.format(previous=previous_membership, current=current_membership)
@@ -0,0 +1,8 @@
+# Prompt templates shared by the data servers
+
+MOBILIZATION_PROMPT = "Please review this location mobilized from {previous} to {current}"
+
+
+def mobilization_prompts(pairs: list[tuple[str, str]]) -> list[str]:
+    """Render the mobilization prompt for many (previous, current) membership pairs at once"""
+    return [MOBILIZATION_PROMPT.format(previous=previous, current=current) for previous, current in pairs]
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 import dotenv
@@ -10,8 +11,10 @@ dotenv.load_dotenv()
 SLACK_APP_TOKEN = os.environ.get("SLACK_APP_TOKEN")
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 
-# Initialize the app
-app = App(token=SLACK_APP_TOKEN)
+HANDLER_WORKERS = 10
+
+# Initialize the app; Bolt acks each event first, then runs its listener on this pool
+app = App(token=SLACK_APP_TOKEN, listener_executor=ThreadPoolExecutor(max_workers=HANDLER_WORKERS))
 
 # Respond to @mentions
 @app.event("app_mention")